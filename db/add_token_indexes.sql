@@ -0,0 +1,8 @@
+-- Adds lookup indexes for the verification and reset token columns
+-- on an existing `users` table. InnoDB builds them online without
+-- blocking reads or writes.
+
+ALTER TABLE `users`
+  ADD KEY `ix_users_reset_token` (`reset_token`),
+  ADD KEY `ix_users_verification_token` (`verification_token`),
+  ALGORITHM=INPLACE, LOCK=NONE;
@@ -51,7 +51,9 @@ ALTER TABLE `users`
   ADD PRIMARY KEY (`id`),
   ADD UNIQUE KEY `email` (`email`),
   ADD UNIQUE KEY `studentId` (`studentId`),
-  ADD UNIQUE KEY `google_id` (`google_id`);
+  ADD UNIQUE KEY `google_id` (`google_id`),
+  ADD KEY `ix_users_reset_token` (`reset_token`),
+  ADD KEY `ix_users_verification_token` (`verification_token`);
 
 --
 -- AUTO_INCREMENT for dumped tables
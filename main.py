@@ -1,29 +1,53 @@
 import os
+import asyncio
+import logging
 import base64
-import uuid
-import smtplib
+import hmac
+import secrets
 from contextlib import asynccontextmanager
-from email.message import EmailMessage
-from email.mime.multipart import MIMEMultipart
-from email.mime.text import MIMEText
-from email.mime.image import MIMEImage
+from email.message import EmailMessage, MIMEPart
 
-from fastapi import FastAPI, HTTPException, Depends
+import aiosmtplib
+import httpx
+from cachetools import TTLCache
+
+from fastapi import FastAPI, HTTPException, Depends, BackgroundTasks
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
 from dotenv import load_dotenv
-from sqlalchemy import Column, Integer, String, select
-from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
-from sqlalchemy.orm import sessionmaker, declarative_base
+from sqlalchemy import Column, Integer, String, select, insert, update, literal, bindparam
+from sqlalchemy.exc import IntegrityError, OperationalError, ProgrammingError
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+from sqlalchemy.orm import declarative_base
 from google.oauth2 import id_token
 from google.auth.transport import requests
+from passlib.hash import bcrypt
 
 load_dotenv()
 
 DATABASE_URL = os.getenv("DATABASE_URL")
 
-engine = create_async_engine(DATABASE_URL, echo=True)
-async_session = sessionmaker(engine, expire_on_commit=False, class_=AsyncSession)
+# Every uvicorn worker gets its own pool, so split a total connection budget
+# (kept below MySQL's default max_connections of 151) across the workers
+WEB_CONCURRENCY = max(1, int(os.getenv("WEB_CONCURRENCY", 1)))
+DB_MAX_CONNECTIONS = int(os.getenv("DB_MAX_CONNECTIONS", 100))
+_worker_connections = max(2, DB_MAX_CONNECTIONS // WEB_CONCURRENCY)
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", min(20, _worker_connections // 2)))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", max(0, min(30, _worker_connections - DB_POOL_SIZE))))
+
+engine = create_async_engine(
+    DATABASE_URL,
+    echo=False,
+    pool_size=DB_POOL_SIZE,
+    max_overflow=DB_MAX_OVERFLOW,
+    pool_timeout=30,
+    pool_pre_ping=True,
+    pool_recycle=1800,
+    query_cache_size=1200
+)
+logging.getLogger("sqlalchemy.engine").setLevel(logging.WARNING)
+logger = logging.getLogger(__name__)
+async_session = async_sessionmaker(engine, expire_on_commit=False)
 Base = declarative_base()
 
 class UserDB(Base):
@@ -35,9 +59,32 @@ class UserDB(Base):
     studentId = Column(String(50), unique=True, nullable=True)
     password = Column(String(255), nullable=True)
     google_id = Column(String(255), unique=True, nullable=True)
-    reset_token = Column(String(255), nullable=True)
+    reset_token = Column(String(255), nullable=True, index=True)
     is_verified = Column(Integer, default=0)  
-    verification_token = Column(String(255), nullable=True)
+    verification_token = Column(String(255), nullable=True, index=True)
+
+# Hot-path statements are built once; values are supplied as bound parameters
+# so every call hits SQLAlchemy's compiled statement cache
+_Q_BY_SID = select(UserDB).where(UserDB.studentId == bindparam("sid"))
+_Q_BY_EMAIL = select(UserDB).where(UserDB.email == bindparam("email"))
+_Q_BY_GOOGLE_ID_OR_EMAIL = select(UserDB).where(
+    (UserDB.google_id == bindparam("google_id")) | (UserDB.email == bindparam("email"))
+)
+_Q_SID_EXISTS = select(literal(1)).where(UserDB.studentId == bindparam("sid")).limit(1)
+_Q_EMAIL_EXISTS = select(literal(1)).where(UserDB.email == bindparam("email")).limit(1)
+_Q_CONSUME_VERIFICATION_TOKEN = (
+    update(UserDB)
+    .where(UserDB.verification_token == bindparam("token"))
+    .values(is_verified=1, verification_token=None)
+    .execution_options(synchronize_session=False)
+)
+_Q_ID_BY_RESET_TOKEN = select(UserDB.id).where(UserDB.reset_token == bindparam("token"))
+_Q_CONSUME_RESET_TOKEN = (
+    update(UserDB)
+    .where(UserDB.id == bindparam("user_id"), UserDB.reset_token == bindparam("token"))
+    .values(password=bindparam("new_password"), reset_token=None)
+    .execution_options(synchronize_session=False)
+)
 
 class User(BaseModel):
     firstName: str
@@ -64,6 +111,42 @@ class GoogleLoginRequest(BaseModel):
     token: str
     studentId: str = None
 
+# Response models let FastAPI serialize straight to JSON through pydantic
+class MessageResponse(BaseModel):
+    message: str
+
+class UserInfo(BaseModel):
+    firstName: str | None
+    lastName: str | None
+    studentId: str | None
+
+class LoginResponse(BaseModel):
+    message: str
+    user: UserInfo
+
+class GoogleLoginResponse(BaseModel):
+    message: str
+    is_new_user: bool
+    user: UserInfo
+
+async def hash_password(password: str) -> str:
+    # bcrypt is CPU-bound, keep it off the event loop
+    return await asyncio.to_thread(bcrypt.hash, password)
+
+# Verified against when there is no stored hash, so unknown accounts take as
+# long to reject as a wrong password
+_DUMMY_PASSWORD_HASH = "$2b$12$R.tO.cK/eIi4YIqZvdSvje82Ga0ILJ4JXHQj2ImCfekjk0v/KT9hG"
+
+async def verify_password(password: str, stored: str | None) -> bool:
+    if not stored:
+        await asyncio.to_thread(bcrypt.verify, password, _DUMMY_PASSWORD_HASH)
+        return False
+    if bcrypt.identify(stored):
+        return await asyncio.to_thread(bcrypt.verify, password, stored)
+    # Accounts created before hashing was introduced store base64-encoded passwords
+    legacy = base64.b64encode(password.encode()).decode()
+    return hmac.compare_digest(stored.encode(), legacy.encode())
+
 HTML_TEMPLATE = """
 <!DOCTYPE html>
 <html>
@@ -102,7 +185,109 @@ HTML_TEMPLATE = """
 </html>
 """
 
-async def send_auth_email(email: str, subject: str, message_text: str, title: str, button_text: str, link: str):
+def _build_email_template(subject: str, title: str, message_text: str, button_text: str) -> dict:
+    # Only the link differs between sends, so render everything else once
+    html = HTML_TEMPLATE.format(
+        title=title,
+        message=message_text,
+        button_text=button_text,
+        link="{link}"
+    )
+    html_prefix, html_suffix = html.split("{link}")
+    return {
+        "subject": subject,
+        "text_prefix": f"{title}\n\n{message_text}\n\n",
+        "html_prefix": html_prefix,
+        "html_suffix": html_suffix
+    }
+
+EMAIL_TEMPLATES = {
+    "welcome": _build_email_template(
+        "Verify Your Email",
+        "Welcome to learnX!",
+        "Thank you for registering with learnX. Please verify your email address to get started.",
+        "Verify Email"
+    ),
+    "verify": _build_email_template(
+        "Verify Your Email",
+        "Verify Your Email",
+        "You requested a new verification link. Please click the button below to verify your account.",
+        "Verify Email"
+    ),
+    "reset_password": _build_email_template(
+        "Password Reset",
+        "Reset Your Password",
+        "We received a request to reset your password. If you didn't make this request, you can safely ignore this email.",
+        "Reset Password"
+    )
+}
+
+LOGO_PATH = os.path.join(os.path.dirname(__file__), "..", "learnX", "public", "logo.png")
+_logo_part: MIMEPart | None = None
+
+def _load_logo_part() -> MIMEPart | None:
+    # Encoded once and attached as-is to every email
+    if not os.path.exists(LOGO_PATH):
+        return None
+    try:
+        with open(LOGO_PATH, "rb") as f:
+            logo_data = f.read()
+    except Exception as e:
+        print(f"Failed to load logo: {e}")
+        return None
+    part = MIMEPart()
+    part.set_content(logo_data, "image", "png", cid="<logo>", disposition="inline", filename="logo.png")
+    return part
+
+_smtp_client: aiosmtplib.SMTP | None = None
+_smtp_key: tuple | None = None
+_smtp_lock = asyncio.Lock()
+
+async def _close_smtp_client():
+    global _smtp_client, _smtp_key
+    if _smtp_client is None:
+        return
+    try:
+        await _smtp_client.quit()
+    except Exception:
+        _smtp_client.close()
+    _smtp_client = None
+    _smtp_key = None
+
+async def _get_smtp_client(smtp_host: str, smtp_port: int, smtp_user: str, smtp_password: str) -> aiosmtplib.SMTP:
+    # Reuse the open connection while it is alive and the credentials are unchanged
+    global _smtp_client, _smtp_key
+    key = (smtp_host, smtp_port, smtp_user)
+    if _smtp_client is not None and _smtp_key == key:
+        try:
+            await _smtp_client.noop()
+            return _smtp_client
+        except (aiosmtplib.SMTPException, OSError):
+            pass
+
+    await _close_smtp_client()
+    client = aiosmtplib.SMTP(
+        hostname=smtp_host,
+        port=smtp_port,
+        use_tls=(smtp_port == 465),
+        start_tls=(smtp_port != 465),
+        timeout=float(os.getenv("SMTP_TIMEOUT", 10))
+    )
+    try:
+        await client.connect()
+        await client.login(smtp_user, smtp_password)
+    except Exception:
+        # Don't leak the socket when login fails after connecting
+        client.close()
+        raise
+    _smtp_client = client
+    _smtp_key = key
+    return client
+
+async def send_auth_email(email: str, kind: str, link: str):
+    template = EMAIL_TEMPLATES[kind]
+    subject = template["subject"]
+
     smtp_host = os.getenv("SMTP_HOST")
     smtp_port = int(os.getenv("SMTP_PORT", 587))
     smtp_user = os.getenv("SMTP_USER")
@@ -110,178 +295,197 @@ async def send_auth_email(email: str, subject: str, message_text: str, title: st
     smtp_from = os.getenv("SMTP_FROM")
 
     if not all([smtp_host, smtp_user, smtp_password]):
-        print(f"SMTP Error: Credentials not fully configured in .env for {subject}")
-        raise HTTPException(status_code=500, detail="Mail server not configured")
+        logger.warning("SMTP credentials not fully configured in .env, skipped %r email to %s", subject, email)
+        return
 
-    msg = MIMEMultipart("related")
+    msg = EmailMessage()
     msg["Subject"] = subject
     msg["From"] = smtp_from
     msg["To"] = email
 
-    msg_alternative = MIMEMultipart("alternative")
-    msg.attach(msg_alternative)
+    # Plain text version, with the HTML version as the preferred alternative
+    msg.set_content(template["text_prefix"] + link)
+    msg.add_alternative(template["html_prefix"] + link + template["html_suffix"], subtype="html")
 
-    # Plain text version
-    part_text = MIMEText(f"{title}\\n\\n{message_text}\\n\\n{link}", "plain")
-    msg_alternative.attach(part_text)
-
-    # HTML version
-    html_content = HTML_TEMPLATE.format(
-        title=title,
-        message=message_text,
-        button_text=button_text,
-        link=link
-    )
-    part_html = MIMEText(html_content, "html")
-    msg_alternative.attach(part_html)
-
-    # Attach logo as inline image
-    logo_path = os.path.join(os.path.dirname(__file__), "..", "learnX", "public", "logo.png")
-    if os.path.exists(logo_path):
-        try:
-            with open(logo_path, "rb") as f:
-                logo_data = f.read()
-                logo_image = MIMEImage(logo_data)
-                logo_image.add_header("Content-ID", "<logo>")
-                logo_image.add_header("Content-Disposition", "inline", filename="logo.png")
-                msg.attach(logo_image)
-        except Exception as e:
-            print(f"Failed to attach logo: {e}")
+    # Attach logo as inline image alongside the HTML part
+    if _logo_part is not None:
+        html_part = msg.get_payload()[1]
+        html_part.make_related()
+        html_part.attach(_logo_part)
 
     try:
-        if smtp_port == 465:
-            server = smtplib.SMTP_SSL(smtp_host, smtp_port)
-        else:
-            server = smtplib.SMTP(smtp_host, smtp_port)
-            server.starttls()
-        
-        with server:
-            server.login(smtp_user, smtp_password)
-            server.send_message(msg)
+        async with _smtp_lock:
+            client = await _get_smtp_client(smtp_host, smtp_port, smtp_user, smtp_password)
+            try:
+                await client.send_message(msg)
+            except Exception:
+                await _close_smtp_client()
+                raise
     except Exception as e:
-        print(f"SMTP error details: {e}")
-        raise HTTPException(status_code=500, detail=f"Failed to send email: {str(e)}")
+        # Runs as a background task after the response, so only report the failure
+        logger.warning("Failed to send %r email to %s: %s", subject, email, e)
+
+async def create_schema():
+    try:
+        async with engine.begin() as conn:
+            await conn.run_sync(Base.metadata.create_all)
+    except (OperationalError, ProgrammingError):
+        # Another worker created the tables/indexes between our existence
+        # check and CREATE; run again so anything still missing is created
+        async with engine.begin() as conn:
+            await conn.run_sync(Base.metadata.create_all)
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    async with engine.begin() as conn:
-        await conn.run_sync(Base.metadata.create_all)
+    global _logo_part
+    _logo_part = _load_logo_part()
+    app.state.http = httpx.AsyncClient(
+        http2=True,
+        timeout=5.0,
+        limits=httpx.Limits(max_keepalive_connections=20)
+    )
+    await create_schema()
     yield
+    await app.state.http.aclose()
+    async with _smtp_lock:
+        await _close_smtp_client()
     await engine.dispose()
 
 app = FastAPI(lifespan=lifespan)
 
+CORS_ORIGINS = [
+    origin.strip()
+    for origin in os.getenv("CORS_ORIGINS", "http://localhost:3000").split(",")
+    if origin.strip()
+]
+
 app.add_middleware(
     CORSMiddleware,
-    allow_origins=["*"], 
+    allow_origins=CORS_ORIGINS,
     allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
+    allow_methods=["GET", "POST"],
+    allow_headers=["Authorization", "Content-Type"],
 )
 
-@app.post("/register")
-async def register(user: User):
+# Issued tokens are 43 chars (token_urlsafe(32)) or 32 for older uuid hex ones;
+# anything longer is rejected outright and never reaches the caches below
+MAX_TOKEN_LENGTH = 64
+
+# Recently rejected tokens per endpoint, so repeated invalid tokens skip the
+# database. Valid tokens are single-use and never cached.
+_bad_verification_tokens = TTLCache(maxsize=10000, ttl=60)
+_bad_reset_tokens = TTLCache(maxsize=10000, ttl=60)
+
+# Reused across calls so the underlying requests.Session keeps its connections
+_google_request = requests.Request()
+
+async def _row_exists(stmt, params: dict) -> bool:
+    # Separate session per probe so several checks can run concurrently
     async with async_session() as session:
-        result = await session.execute(
-            select(UserDB).where(
-                (UserDB.studentId == user.studentId) | (UserDB.email == user.email)
+        return await session.scalar(stmt, params) is not None
+
+@app.post("/register")
+async def register(user: User, background_tasks: BackgroundTasks) -> MessageResponse:
+    hashed_password = await hash_password(user.password)
+    verification_token = secrets.token_urlsafe(32)
+    try:
+        # Rely on the unique keys instead of a pre-check so concurrent
+        # registrations cannot both slip through
+        async with async_session() as session:
+            await session.execute(
+                insert(UserDB).values(
+                    firstName=user.firstName,
+                    lastName=user.lastName,
+                    email=user.email,
+                    studentId=user.studentId,
+                    password=hashed_password,
+                    is_verified=0,
+                    verification_token=verification_token
+                )
             )
+            await session.commit()
+    except IntegrityError:
+        # Only reached on a collision; find out which field caused it
+        sid_exists, email_exists = await asyncio.gather(
+            _row_exists(_Q_SID_EXISTS, {"sid": user.studentId}),
+            _row_exists(_Q_EMAIL_EXISTS, {"email": user.email})
         )
-        existing_user = result.scalars().first()
-        if existing_user:
-            if existing_user.studentId == user.studentId:
-                raise HTTPException(status_code=400, detail="Student ID already registered")
-            else:
-                raise HTTPException(status_code=400, detail="Email already registered")
-        
-        encoded_password = base64.b64encode(user.password.encode()).decode()
-        verification_token = uuid.uuid4().hex
-        new_user = UserDB(
-            firstName=user.firstName,
-            lastName=user.lastName,
-            email=user.email,
-            studentId=user.studentId,
-            password=encoded_password,
-            is_verified=0,
-            verification_token=verification_token
-        )
-        session.add(new_user)
-        await session.commit()
-        
-        frontend_url = os.getenv("FRONTEND_URL", "http://localhost:3000")
-        verify_link = f"{frontend_url}/verify-email?token={verification_token}"
-        await send_auth_email(
-            user.email, 
-            "Verify Your Email", 
-            "Thank you for registering with learnX. Please verify your email address to get started.",
-            "Welcome to learnX!",
-            "Verify Email",
-            verify_link
-        )
-        
-        return {"message": "User registered successfully. Please check your email to verify your account."}
+        if sid_exists:
+            raise HTTPException(status_code=400, detail="Student ID already registered")
+        if email_exists:
+            raise HTTPException(status_code=400, detail="Email already registered")
+        raise HTTPException(status_code=400, detail="User already registered")
+
+    frontend_url = os.getenv("FRONTEND_URL", "http://localhost:3000")
+    verify_link = f"{frontend_url}/verify-email?token={verification_token}"
+    background_tasks.add_task(send_auth_email, user.email, "welcome", verify_link)
+    
+    return MessageResponse(message="User registered successfully. Please check your email to verify your account.")
 
 @app.post("/login")
-async def login(user_login: UserLogin):
+async def login(user_login: UserLogin) -> LoginResponse:
     async with async_session() as session:
-        encoded_password = base64.b64encode(user_login.password.encode()).decode()
-        result = await session.execute(
-            select(UserDB).where(
-                UserDB.studentId == user_login.studentId,
-                UserDB.password == encoded_password
-            )
-        )
+        result = await session.execute(_Q_BY_SID, {"sid": user_login.studentId})
         user = result.scalars().first()
         
-        if user:
+        # Always run a bcrypt verify so response time doesn't reveal whether the studentId exists
+        if await verify_password(user_login.password, user.password if user else None):
+            if not bcrypt.identify(user.password):
+                # Upgrade legacy base64 passwords on successful login
+                user.password = await hash_password(user_login.password)
+                await session.commit()
+
             if not user.is_verified:
                 raise HTTPException(
                     status_code=403, 
                     detail={"message": "Email not verified", "email": user.email}
                 )
                 
-            return {
-                "message": "Login successful",
-                "user": {
-                    "firstName": user.firstName,
-                    "lastName": user.lastName,
-                    "studentId": user.studentId
-                }
-            }
+            return LoginResponse(
+                message="Login successful",
+                user=UserInfo(
+                    firstName=user.firstName,
+                    lastName=user.lastName,
+                    studentId=user.studentId
+                )
+            )
         
     raise HTTPException(status_code=401, detail="Invalid student ID or password")
 
 @app.post("/google-login")
-async def google_login(req: GoogleLoginRequest):
+async def google_login(req: GoogleLoginRequest) -> GoogleLoginResponse:
     try:
         # First try to verify as ID token
         client_id = os.getenv("GOOGLE_CLIENT_ID")
         try:
-            idinfo = id_token.verify_oauth2_token(req.token, requests.Request(), client_id)
+            idinfo = await asyncio.to_thread(
+                id_token.verify_oauth2_token, req.token, _google_request, client_id
+            )
             email = idinfo['email']
             google_id = idinfo['sub']
             first_name = idinfo.get('given_name', '')
             last_name = idinfo.get('family_name', '')
         except Exception:
             # If ID token verification fails, try as access token by fetching user info
-            import httpx
-            async with httpx.AsyncClient() as client:
-                res = await client.get(
-                    "https://www.googleapis.com/oauth2/v3/userinfo",
-                    headers={"Authorization": f"Bearer {req.token}"}
-                )
-                if res.status_code != 200:
-                    raise HTTPException(status_code=400, detail="Invalid Google token")
-                userinfo = res.json()
-                email = userinfo['email']
-                google_id = userinfo['sub']
-                first_name = userinfo.get('given_name', '')
-                last_name = userinfo.get('family_name', '')
+            res = await app.state.http.get(
+                "https://www.googleapis.com/oauth2/v3/userinfo",
+                headers={"Authorization": f"Bearer {req.token}"}
+            )
+            if res.status_code != 200:
+                raise HTTPException(status_code=400, detail="Invalid Google token")
+            userinfo = res.json()
+            email = userinfo['email']
+            google_id = userinfo['sub']
+            first_name = userinfo.get('given_name', '')
+            last_name = userinfo.get('family_name', '')
         
         async with async_session() as session:
-            # 1. Check if user exists by google_id
-            result = await session.execute(select(UserDB).where(UserDB.google_id == google_id))
-            user = result.scalars().first()
+            # 1. Fetch users matching either google_id or email in one round-trip
+            result = await session.execute(
+                _Q_BY_GOOGLE_ID_OR_EMAIL, {"google_id": google_id, "email": email}
+            )
+            matches = result.scalars().all()
+            user = next((u for u in matches if u.google_id == google_id), None)
             
             is_new_user = False
             
@@ -289,16 +493,14 @@ async def google_login(req: GoogleLoginRequest):
                 # Existing Google user
                 if req.studentId and not user.studentId:
                     # Check if requested studentId is already taken by another user
-                    sid_check = await session.execute(select(UserDB).where(UserDB.studentId == req.studentId))
-                    if sid_check.scalars().first():
+                    if await session.scalar(_Q_SID_EXISTS, {"sid": req.studentId}):
                         raise HTTPException(status_code=400, detail="Student ID already registered")
                     user.studentId = req.studentId
                     await session.commit()
             else:
                 # Potential new user or existing email/pass user
                 # 2. Check if user exists by email
-                email_check = await session.execute(select(UserDB).where(UserDB.email == email))
-                existing_email_user = email_check.scalars().first()
+                existing_email_user = next((u for u in matches if u.email == email), None)
                 
                 if existing_email_user:
                     # Email exists but doesn't have this google_id
@@ -309,8 +511,7 @@ async def google_login(req: GoogleLoginRequest):
                 
                 # 3. Check studentId if provided
                 if req.studentId:
-                    sid_check = await session.execute(select(UserDB).where(UserDB.studentId == req.studentId))
-                    if sid_check.scalars().first():
+                    if await session.scalar(_Q_SID_EXISTS, {"sid": req.studentId}):
                         raise HTTPException(status_code=400, detail="Student ID already registered")
                 
                 # 4. Create new user
@@ -327,15 +528,15 @@ async def google_login(req: GoogleLoginRequest):
                 await session.commit()
                 await session.refresh(user)
             
-            return {
-                "message": "Login successful",
-                "is_new_user": is_new_user,
-                "user": {
-                    "firstName": user.firstName,
-                    "lastName": user.lastName,
-                    "studentId": user.studentId or "Google User"
-                }
-            }
+            return GoogleLoginResponse(
+                message="Login successful",
+                is_new_user=is_new_user,
+                user=UserInfo(
+                    firstName=user.firstName,
+                    lastName=user.lastName,
+                    studentId=user.studentId or "Google User"
+                )
+            )
             
     except HTTPException:
         raise
@@ -344,51 +545,45 @@ async def google_login(req: GoogleLoginRequest):
         raise HTTPException(status_code=400, detail="Invalid Google token")
 
 @app.get("/verify-email")
-async def verify_email(token: str):
+async def verify_email(token: str) -> MessageResponse:
+    if len(token) > MAX_TOKEN_LENGTH or token in _bad_verification_tokens:
+        raise HTTPException(status_code=400, detail="Invalid or expired verification token")
+
     async with async_session() as session:
-        result = await session.execute(select(UserDB).where(UserDB.verification_token == token))
-        user = result.scalars().first()
+        result = await session.execute(_Q_CONSUME_VERIFICATION_TOKEN, {"token": token})
         
-        if not user:
+        if result.rowcount == 0:
+            _bad_verification_tokens[token] = 1
             raise HTTPException(status_code=400, detail="Invalid or expired verification token")
         
-        user.is_verified = 1
-        user.verification_token = None
         await session.commit()
-        return {"message": "Email verified successfully"}
+        return MessageResponse(message="Email verified successfully")
 
 @app.post("/resend-verification")
-async def resend_verification(req: ResendVerificationRequest):
+async def resend_verification(req: ResendVerificationRequest, background_tasks: BackgroundTasks) -> MessageResponse:
     async with async_session() as session:
-        result = await session.execute(select(UserDB).where(UserDB.email == req.email))
+        result = await session.execute(_Q_BY_EMAIL, {"email": req.email})
         user = result.scalars().first()
         
         if not user:
             raise HTTPException(status_code=404, detail="Email not found")
         
         if user.is_verified:
-            return {"message": "Email is already verified"}
+            return MessageResponse(message="Email is already verified")
         
-        token = uuid.uuid4().hex
+        token = secrets.token_urlsafe(32)
         user.verification_token = token
         await session.commit()
         
         frontend_url = os.getenv("FRONTEND_URL", "http://localhost:3000")
         verify_link = f"{frontend_url}/verify-email?token={token}"
-        await send_auth_email(
-            user.email, 
-            "Verify Your Email", 
-            "You requested a new verification link. Please click the button below to verify your account.",
-            "Verify Your Email",
-            "Verify Email",
-            verify_link
-        )
-        return {"message": "Verification email resent"}
+        background_tasks.add_task(send_auth_email, user.email, "verify", verify_link)
+        return MessageResponse(message="Verification email resent")
 
 @app.post("/forgot-password")
-async def forgot_password(req: ForgotPasswordRequest):
+async def forgot_password(req: ForgotPasswordRequest, background_tasks: BackgroundTasks) -> MessageResponse:
     async with async_session() as session:
-        result = await session.execute(select(UserDB).where(UserDB.email == req.email))
+        result = await session.execute(_Q_BY_EMAIL, {"email": req.email})
         user = result.scalars().first()
         
         if not user:
@@ -400,37 +595,49 @@ async def forgot_password(req: ForgotPasswordRequest):
                 detail="This account is linked with Google. Please use 'Sign in with Google'."
             )
         
-        token = uuid.uuid4().hex
+        token = secrets.token_urlsafe(32)
         user.reset_token = token
         await session.commit()
         
         frontend_url = os.getenv("FRONTEND_URL", "http://localhost:3000")
         reset_link = f"{frontend_url}/reset-password?token={token}"
-        await send_auth_email(
-            user.email, 
-            "Password Reset", 
-            "We received a request to reset your password. If you didn't make this request, you can safely ignore this email.",
-            "Reset Your Password",
-            "Reset Password",
-            reset_link
-        )
-        return {"message": "Reset email sent"}
+        background_tasks.add_task(send_auth_email, user.email, "reset_password", reset_link)
+        return MessageResponse(message="Reset email sent")
 
 @app.post("/reset-password")
-async def reset_password(req: ResetPasswordRequest):
+async def reset_password(req: ResetPasswordRequest) -> MessageResponse:
+    if len(req.token) > MAX_TOKEN_LENGTH or req.token in _bad_reset_tokens:
+        raise HTTPException(status_code=400, detail="Invalid or expired token")
+
+    # Check the token before paying for bcrypt so unknown tokens stay cheap
     async with async_session() as session:
-        result = await session.execute(select(UserDB).where(UserDB.reset_token == req.token))
-        user = result.scalars().first()
+        user_id = await session.scalar(_Q_ID_BY_RESET_TOKEN, {"token": req.token})
+    if user_id is None:
+        _bad_reset_tokens[req.token] = 1
+        raise HTTPException(status_code=400, detail="Invalid or expired token")
+
+    hashed_password = await hash_password(req.new_password)
+    async with async_session() as session:
+        result = await session.execute(
+            _Q_CONSUME_RESET_TOKEN,
+            {"user_id": user_id, "token": req.token, "new_password": hashed_password}
+        )
         
-        if not user:
+        # The token may have been used by a concurrent request meanwhile
+        if result.rowcount == 0:
+            _bad_reset_tokens[req.token] = 1
             raise HTTPException(status_code=400, detail="Invalid or expired token")
         
-        encoded_password = base64.b64encode(req.new_password.encode()).decode()
-        user.password = encoded_password
-        user.reset_token = None
         await session.commit()
-        return {"message": "Password reset successfully"}
+        return MessageResponse(message="Password reset successfully")
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run("main:app", host="0.0.0.0", port=8000, reload=True)
+    if os.getenv("DEV") == "1":
+        uvicorn.run("main:app", host="0.0.0.0", port=8000, reload=True)
+    else:
+        # loop/http "auto" pick uvloop and httptools when installed (uvicorn[standard])
+        workers = int(os.getenv("WEB_CONCURRENCY", (os.cpu_count() or 1) * 2 + 1))
+        # Workers read this at import to size their share of the DB pool
+        os.environ["WEB_CONCURRENCY"] = str(workers)
+        uvicorn.run("main:app", host="0.0.0.0", port=8000, workers=workers, loop="auto", http="auto")